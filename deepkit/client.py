@@ -1,111 +1,215 @@
 import asyncio
+import concurrent.futures
 import inspect
+import itertools
 import json
 import os
 import sys
 import threading
-from datetime import datetime
-from typing import Dict, List, Optional
+import time
+from collections import deque
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
+import orjson
 import websockets
 from rx.subject import BehaviorSubject
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 import deepkit.globals
 from deepkit.home import get_home_config
-from deepkit.model import ContextOptions, FolderLink
+from deepkit.model import ContextOptions, FolderLink, HomeConfig
+
+
+@lru_cache(maxsize=256)
+def _realpath(path: str) -> str:
+    return os.path.realpath(path)
 
 
 def is_in_directory(filepath, directory):
-    return os.path.realpath(filepath).startswith(os.path.realpath(directory))
+    real_directory = _realpath(directory)
+    try:
+        return os.path.commonpath([_realpath(filepath), real_directory]) == real_directory
+    except ValueError:
+        # e.g. different drives on Windows
+        return False
+
+
+@lru_cache(maxsize=None)
+def get_action_parameters(fn) -> List[Dict]:
+    """
+    Returns the parameter descriptors of a controller action, as sent in `actionTypes/result`.
+    Pass the plain function (not the bound method), so the cache does not keep controllers alive.
+    """
+    return [{'type': 'any', 'name': '#' + str(i)} for i, _ in enumerate(inspect.getfullargspec(fn).args)]
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Uses uvloop when installed (`pip install deepkit[uvloop]`), without changing the global event loop policy.
+    """
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+shared_loop: Optional[asyncio.AbstractEventLoop] = None
+shared_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop shared by all clients. It's started lazily in one daemon thread for the whole SDK.
+    """
+    global shared_loop
+    with shared_loop_lock:
+        if shared_loop is None:
+            shared_loop = new_event_loop()
+            threading.Thread(target=shared_loop.run_forever, name='deepkit-client', daemon=True).start()
+    return shared_loop
+
+
+def _reset_shared_loop():
+    # the thread running the loop doesn't exist in a forked child, and the lock might have been held while forking
+    global shared_loop, shared_loop_lock
+    shared_loop = None
+    shared_loop_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_shared_loop)
+
+
+def dumps(message) -> str:
+    """
+    Serializes an outgoing message. Decoded to str, so it's still sent as a text frame.
+    """
+    try:
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode('utf8')
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bit, which the stdlib encoder still handles
+        return json.dumps(message)
+
+
+def open_connection(uri: str):
+    """
+    Opens the websocket connection to the Deepkit server.
+    Messages are small JSON documents, for which per-message deflate costs more CPU than it saves bandwidth.
+    """
+    return websockets.connect(uri, compression=None, max_size=2 ** 22, write_limit=2 ** 18,
+                              ping_interval=20, ping_timeout=20)
+
+
+# responses not received within this many seconds are considered lost (actions use a timeout of 60)
+CALLBACK_TIMEOUT = 120
+# seconds between two sweeps for lost responses
+REAP_INTERVAL = 30
+# seconds stop_and_sync waits for queued messages and patches to be sent
+DRAIN_TIMEOUT = 10
+
+# job status: done = 150, aborted = 200, failed = 250, crashed = 300
+# task and instance status: done = 500, aborted = 550, failed = 600, crashed = 650
+PATCHES_DONE = {'status': 150, 'tasks.main.status': 500, 'tasks.main.instances.0.status': 500}
+PATCHES_ABORTED = {'status': 200, 'tasks.main.status': 550, 'tasks.main.instances.0.status': 550}
+PATCHES_CRASHED = {'status': 300, 'tasks.main.status': 650, 'tasks.main.instances.0.status': 650}
 
 
 class ApiError(Exception):
     pass
 
 
-class Client(threading.Thread):
+class Client:
     connection: websockets.WebSocketClientProtocol
 
-    def __init__(self, options: ContextOptions):
+    def __init__(self, options: ContextOptions, connect: bool = True):
         self.connected = BehaviorSubject(False)
         self.options: ContextOptions = options
 
-        self.loop = asyncio.new_event_loop()
+        self.loop = get_loop()
+        # created before connecting starts, so actions scheduled early never see a missing future
+        self.connecting = self.loop.create_future()
         self.host = os.environ.get('DEEPKIT_HOST', '127.0.0.1')
         self.port = int(os.environ.get('DEEPKIT_PORT', '8960'))
         self.token = os.environ.get('DEEPKIT_JOB_ACCESSTOKEN', None)
         self.job_id = os.environ.get('DEEPKIT_JOB_ID', None)
-        self.message_id = 0
+        self._message_ids = itertools.count(1)
         self.account = 'localhost'
-        self.callbacks: Dict[int, asyncio.Future] = {}
+        self._home_config: Optional[HomeConfig] = None
+        self.callbacks: Dict[int, Tuple[asyncio.Future, float]] = {}
         self.subscriber: Dict[int, any] = {}
         self.stopping = False
-        self.queue = []
+        self.queue = deque()
+        self._queue_waker: Optional[asyncio.Future] = None
+        self._wakeup_pending = False
+        self._drained: Optional[asyncio.Future] = None
         self.controllers = {}
         self.patches = {}
         self.offline = False
         self.connections = 0
         self.lock = threading.Lock()
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.loop = asyncio.new_event_loop()
-        self.start()
+        if connect:
+            self.connect()
 
-    def run(self):
-        self.connecting = self.loop.create_future()
+    def connect(self):
+        self.loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
         self.loop.create_task(self._connect())
-        self.loop.run_forever()
+        self.loop.create_task(self._reap_callbacks())
 
     def shutdown(self):
         if self.offline: return
         promise = asyncio.run_coroutine_threadsafe(self.stop_and_sync(), self.loop)
-        promise.result()
+        try:
+            promise.result(timeout=15)
+        except concurrent.futures.TimeoutError:
+            print("Deepkit: could not sync job data in time.", file=sys.stderr)
+            promise.cancel()
+            return
         if not self.connection.closed:
             raise Exception('Connection still active')
-        self.loop.stop()
 
     async def stop_and_sync(self):
         self.stopping = True
+        now = datetime.now(timezone.utc)
 
-        # done = 150, //when all tasks are done
-        # aborted = 200, //when at least one task aborted
-        # failed = 250, //when at least one task failed
-        # crashed = 300, //when at least one task crashed
-        self.patches['status'] = 150
-        self.patches['ended'] = datetime.utcnow().isoformat()
-        self.patches['tasks.main.ended'] = datetime.utcnow().isoformat()
-
-        # done = 500,
-        # aborted = 550,
-        # failed = 600,
-        # crashed = 650,
-        self.patches['tasks.main.status'] = 500
-        self.patches['tasks.main.instances.0.ended'] = datetime.utcnow().isoformat()
-
-        # done = 500,
-        # aborted = 550,
-        # failed = 600,
-        # crashed = 650,
-        self.patches['tasks.main.instances.0.status'] = 500
-
-        if hasattr(sys, 'last_value'):
-            if isinstance(sys.last_value, KeyboardInterrupt):
-                self.patches['status'] = 200
-                self.patches['tasks.main.status'] = 550
-                self.patches['tasks.main.instances.0.status'] = 550
-            else:
-                self.patches['status'] = 300
-                self.patches['tasks.main.status'] = 650
-                self.patches['tasks.main.instances.0.status'] = 650
+        if not hasattr(sys, 'last_value'):
+            status = PATCHES_DONE
+        elif isinstance(sys.last_value, KeyboardInterrupt):
+            status = PATCHES_ABORTED
+        else:
+            status = PATCHES_CRASHED
+
+        with self.lock:
+            self.patches.update(status)
+            self.patches['ended'] = now
+            self.patches['tasks.main.ended'] = now
+            self.patches['tasks.main.instances.0.ended'] = now
 
-        while len(self.patches) > 0 or len(self.queue) > 0:
-            await asyncio.sleep(0.15)
+        if len(self.patches) > 0 or len(self.queue) > 0:
+            self._drained = self.loop.create_future()
+            self._wakeup()
+            try:
+                await asyncio.wait_for(self._drained, timeout=DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("Deepkit: not all job data could be sent.", file=sys.stderr)
 
         await self.connection.close()
 
     async def register_controller(self, name: str, controller):
         self.controllers[name] = controller
 
+        # constant part of every message sent back to the peer
+        envelope = {'name': 'peerController/message', 'controllerName': name}
+
+        async def reply(message, data):
+            await self._message({**envelope, 'clientId': message['clientId'], 'data': data}, no_response=True)
+
         async def subscriber(message, done):
             if message['type'] == 'error':
                 done()
@@ -121,60 +225,33 @@ class Client(threading.Thread):
                 if not hasattr(controller, data['action']):
                     error = f"Requested action {message['action']} not available in {name}"
                     print(error, file=sys.stderr)
-                    await self._message({
-                        'name': 'peerController/message',
-                        'controllerName': name,
-                        'clientId': message['clientId'],
-                        'data': {'type': 'error', 'id': data['id'], 'stack': None, 'entityName': '@error:default',
-                                 'error': error}
-                    }, no_response=True)
+                    await reply(message, {'type': 'error', 'id': data['id'], 'stack': None,
+                                          'entityName': '@error:default', 'error': error})
 
                 if data['name'] == 'actionTypes':
-                    parameters = []
+                    action = getattr(controller, data['action'])
+                    parameters = get_action_parameters(getattr(action, '__func__', action))
 
-                    i = 0
-                    for arg in inspect.getfullargspec(getattr(controller, data['action'])).args:
-                        parameters.append({
-                            'type': 'any',
-                            'name': '#' + str(i)
-                        })
-                        i += 1
-
-                    await self._message({
-                        'name': 'peerController/message',
-                        'controllerName': name,
-                        'clientId': message['clientId'],
-                        'data': {
-                            'type': 'actionTypes/result',
-                            'id': data['id'],
-                            'parameters': parameters,
-                            'returnType': {'type': 'any', 'name': 'result'}
-                        }
-                    }, no_response=True)
+                    await reply(message, {
+                        'type': 'actionTypes/result',
+                        'id': data['id'],
+                        'parameters': parameters,
+                        'returnType': {'type': 'any', 'name': 'result'}
+                    })
 
                 if data['name'] == 'action':
                     try:
                         res = getattr(controller, data['action'])(*data['args'])
 
-                        await self._message({
-                            'name': 'peerController/message',
-                            'controllerName': name,
-                            'clientId': message['clientId'],
-                            'data': {
-                                'type': 'next/json',
-                                'id': data['id'],
-                                'encoding': {'name': 'r', 'type': 'any'},
-                                'next': res,
-                            }
-                        }, no_response=True)
+                        await reply(message, {
+                            'type': 'next/json',
+                            'id': data['id'],
+                            'encoding': {'name': 'r', 'type': 'any'},
+                            'next': res,
+                        })
                     except Exception as e:
-                        await self._message({
-                            'name': 'peerController/message',
-                            'controllerName': name,
-                            'clientId': message['clientId'],
-                            'data': {'type': 'error', 'id': data['id'], 'stack': None, 'entityName': '@error:default',
-                                     'error': str(e)}
-                        }, no_response=True)
+                        await reply(message, {'type': 'error', 'id': data['id'], 'stack': None,
+                                              'entityName': '@error:default', 'error': str(e)})
 
         await self._subscribe({
             'name': 'peerController/register',
@@ -224,10 +301,8 @@ class Client(threading.Thread):
     async def _subscribe(self, message, subscriber):
         await self.connecting
 
-        self.message_id += 1
-        message['id'] = self.message_id
-
-        message_id = self.message_id
+        message_id = next(self._message_ids)
+        message['id'] = message_id
 
         def on_done():
             del self.subscriber[message_id]
@@ -235,37 +310,111 @@ class Client(threading.Thread):
         async def on_incoming_message(incoming_message):
             await subscriber(incoming_message, on_done)
 
-        self.subscriber[self.message_id] = on_incoming_message
+        self.subscriber[message_id] = on_incoming_message
         self.queue.append(message)
+        self._wakeup()
 
     async def _message(self, message, lock=True, no_response=False):
         if lock: await self.connecting
 
-        self.message_id += 1
-        message['id'] = self.message_id
+        message_id = next(self._message_ids)
+        message['id'] = message_id
         if not no_response:
-            self.callbacks[self.message_id] = self.loop.create_future()
+            future = self.loop.create_future()
+            self.callbacks[message_id] = (future, time.monotonic())
 
         self.queue.append(message)
+        self._wakeup()
 
         if no_response:
             return
 
-        return await self.callbacks[self.message_id]
+        return await future
+
+    async def _reap_callbacks(self):
+        """
+        Fails and drops callbacks whose response never arrived (e.g. lost during a reconnect), so they don't pile up.
+        """
+        while not self.stopping and not self.offline:
+            await asyncio.sleep(REAP_INTERVAL)
+            now = time.monotonic()
+            for message_id, (future, created) in list(self.callbacks.items()):
+                if now - created > CALLBACK_TIMEOUT:
+                    del self.callbacks[message_id]
+                    if not future.done():
+                        future.set_exception(asyncio.TimeoutError(f'No response for message {message_id}'))
 
     def patch(self, path: str, value: any):
         if self.offline: return
         if self.stopping: return
 
-        self.patches[path] = value
+        # self.patches is swapped by send_messages in the loop's thread
+        with self.lock:
+            self.patches[path] = value
+        # patch() is called from the user's thread, so the sender is woken up through the loop.
+        # Only one wakeup is scheduled at a time, so patches of e.g. one iteration are sent together.
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._wakeup_from_thread)
+
+    def _wakeup_from_thread(self):
+        self._wakeup_pending = False
+        self._wakeup()
+
+    def _dumps_patches(self) -> Optional[str]:
+        """
+        Encodes the patchJob action for the current patches. Values that can't be serialized are dropped,
+        so one bad value doesn't stop syncing the rest. Returns None when no patch is left.
+        """
+
+        def patch_job():
+            return dumps({
+                'name': 'action',
+                'controller': 'job',
+                'action': 'patchJob',
+                'args': [
+                    self.patches
+                ],
+                'timeout': 60
+            })
+
+        try:
+            return patch_job()
+        except TypeError:
+            pass
+
+        for path, value in list(self.patches.items()):
+            try:
+                dumps(value)
+            except TypeError as e:
+                print(f"Deepkit: could not sync {path}: {e}", file=sys.stderr)
+                del self.patches[path]
+
+        return patch_job() if self.patches else None
+
+    def _wakeup(self):
+        """
+        Wakes up send_messages() waiting for new messages or patches. Needs to be called in the loop's thread.
+        """
+        if self._queue_waker is not None and not self._queue_waker.done():
+            self._queue_waker.set_result(None)
 
     async def send_messages(self, connection):
-        while not connection.closed:
+        while connection.open:
             try:
-                q = self.queue[:]
-                for m in q:
-                    await connection.send(json.dumps(m))
-                    self.queue.remove(m)
+                # _connect may swap in a fresh queue while we wait on send(), so stick to the one we drain
+                queue = self.queue
+                while queue:
+                    try:
+                        data = dumps(queue[0])
+                    except TypeError as e:
+                        # not serializable, drop it instead of blocking every message behind it
+                        self._fail_message(queue.popleft(), e)
+                        continue
+
+                    # removed only once sent, so it's sent again after a reconnect
+                    await connection.send(data)
+                    queue.popleft()
             except Exception as e:
                 print("Failed sending, exit send_messages")
                 raise e
@@ -276,47 +425,71 @@ class Client(threading.Thread):
                 # patches are based on previously created entities,
                 # so we need to make sure those entities are created
                 # first before sending any patches.
+                with self.lock:
+                    # encoded before taking them, so a value that can't be serialized never costs the whole batch
+                    data = self._dumps_patches()
+                    send = self.patches
+                    self.patches = {}
+
+                if data is None:
+                    continue
+
                 try:
-                    send = self.patches.copy()
-                    await connection.send(json.dumps({
-                        'name': 'action',
-                        'controller': 'job',
-                        'action': 'patchJob',
-                        'args': [
-                            send
-                        ],
-                        'timeout': 60
-                    }))
-
-                    for i in send.keys():
-                        if self.patches[i] == send[i]:
-                            del self.patches[i]
-                except websockets.exceptions.ConnectionClosed:
-                    return
-                except ApiError:
-                    print("Patching failed. Syncing job data disabled.", file=sys.stderr)
+                    await connection.send(data)
+                except (websockets.exceptions.ConnectionClosed, ApiError) as e:
+                    # put them back, patches made in the meantime are newer and win
+                    with self.lock:
+                        send.update(self.patches)
+                        self.patches = send
+                    if isinstance(e, ApiError):
+                        print("Patching failed. Syncing job data disabled.", file=sys.stderr)
                     return
 
-            await asyncio.sleep(0.2)
+                # patches might have been added while sending
+                continue
+
+            if self.queue:
+                continue
+
+            if self._drained is not None and not self._drained.done():
+                self._drained.set_result(None)
+
+            # all senders share one waker, so a reconnect never leaves an old sender waiting forever
+            if self._queue_waker is None or self._queue_waker.done():
+                self._queue_waker = self.loop.create_future()
+            await self._queue_waker
+
+    def _fail_message(self, message, error: Exception):
+        print(f"Deepkit: could not send message {message.get('name')}: {error}", file=sys.stderr)
+        callback = self.callbacks.pop(message.get('id'), None)
+        if callback is not None and not callback[0].done():
+            callback[0].set_exception(error)
 
     async def handle_messages(self, connection):
         while not connection.closed:
             try:
-                res = json.loads(await connection.recv())
+                res = orjson.loads(await connection.recv())
             except websockets.exceptions.ConnectionClosedError:
                 # we need reconnect
                 break
             except websockets.exceptions.ConnectionClosedOK:
                 # we closed on purpose, so no reconnect necessary
+                self._wakeup()
                 return
 
-            if res and 'id' in res:
-                if res['id'] in self.subscriber:
-                    await self.subscriber[res['id']](res)
+            res_id = res.get('id') if res else None
+            if res_id is not None:
+                # subscriptions receive many messages, they are removed via their done callback
+                subscriber = self.subscriber.get(res_id)
+                if subscriber is not None:
+                    await subscriber(res)
 
-                if res['id'] in self.callbacks:
-                    self.callbacks[res['id']].set_result(res)
-                    del self.callbacks[res['id']]
+                callback = self.callbacks.pop(res_id, None)
+                if callback is not None and not callback[0].done():
+                    callback[0].set_result(res)
+
+        # let send_messages notice the closed connection
+        self._wakeup()
 
         if not self.stopping:
             print("Deepkit: lost connection. reconnect ...")
@@ -326,7 +499,7 @@ class Client(threading.Thread):
 
     async def _connect_job(self, host: str, port: int, id: str, token: str):
         try:
-            self.connection = await websockets.connect(f"ws://{host}:{port}")
+            self.connection = await open_connection(f"ws://{host}:{port}")
         except Exception:
             # try again later
             await asyncio.sleep(1)
@@ -336,6 +509,9 @@ class Client(threading.Thread):
         self.loop.create_task(self.handle_messages(self.connection))
         self.loop.create_task(self.send_messages(self.connection))
 
+        await self._authenticate_job(id, token)
+
+    async def _authenticate_job(self, id: str, token: str):
         res = await self._message({
             'name': 'authenticate',
             'token': {
@@ -357,13 +533,16 @@ class Client(threading.Thread):
 
     async def _connect(self):
         # we want to restart with a empty queue, so authentication happens always first
-        queue_copy = self.queue[:]
-        self.queue = []
+        queue_copy = self.queue
+        self.queue = deque()
 
         if self.token:
             await self._connect_job(self.host, self.port, self.job_id, self.token)
         else:
-            config = get_home_config()
+            # read once, reconnects within the same process use the same account
+            if self._home_config is None:
+                self._home_config = get_home_config()
+            config = self._home_config
             link: Optional[FolderLink] = None
             if self.options.account:
                 account_config = config.get_account_for_name(self.options.account)
@@ -376,7 +555,7 @@ class Client(threading.Thread):
             ws = 'wss' if account_config.ssl else 'ws'
 
             try:
-                self.connection = await websockets.connect(f"{ws}://{self.host}:{self.port}")
+                self.connection = await open_connection(f"{ws}://{self.host}:{self.port}")
             except Exception as e:
                 self.offline = True
                 print(f"Deepkit: App not started or server not reachable. Monitoring disabled. {e}")
@@ -416,8 +595,9 @@ class Client(threading.Thread):
             self.token = await self._action('app', 'getJobAccessToken', [job['id']], lock=False)
             self.job_id = job['id']
 
-            # todo, implement re-authentication, so we don't have to drop the active connection
-            await self.connection.close()
-            await self._connect_job(self.host, self.port, self.job_id, self.token)
+            # re-authenticate as the job on the active connection
+            await self._authenticate_job(self.job_id, self.token)
 
-        self.queue = queue_copy + self.queue
+        queue_copy.extend(self.queue)
+        self.queue = queue_copy
+        self._wakeup()
@@ -21,5 +21,9 @@ setup(name='deepkit',
                         'PyYAML>=5.0.0',
                         'psutil>=5.4.6',
                         'websockets>=7.0',
-                        'simplejson>=3.13.2']
+                        'orjson>=3.4',
+                        'simplejson>=3.13.2'],
+      extras_require={
+          'uvloop': ['uvloop>=0.14'],
+      }
 )
\ No newline at end of file
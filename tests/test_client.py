@@ -0,0 +1,312 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+import websockets
+
+import deepkit.client
+
+from deepkit.client import Client, get_action_parameters, is_in_directory, PATCHES_DONE, PATCHES_ABORTED, \
+    PATCHES_CRASHED
+from deepkit.model import ContextOptions, HomeConfig, Account
+
+
+class FakeConnection:
+    def __init__(self, on_send=None):
+        self.open = True
+        self.closed = False
+        self.sent = []
+        self.on_send = on_send
+
+    async def send(self, data):
+        message = json.loads(data)
+        if self.on_send:
+            self.on_send(message)
+        self.sent.append(message)
+
+    async def close(self):
+        self.open = False
+        self.closed = True
+
+
+def create_client(options: ContextOptions = None) -> Client:
+    return Client(options or ContextOptions(), connect=False)
+
+
+def run(client: Client, coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, client.loop).result(timeout=5)
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.01)
+
+
+def stop_sender(client: Client, connection: FakeConnection, sender):
+    run(client, connection.close())
+    client.loop.call_soon_threadsafe(client._wakeup)
+    sender.result(timeout=5)
+
+
+def test_patch_wakes_sender_once(monkeypatch):
+    client = create_client()
+    connection = FakeConnection()
+    sender = asyncio.run_coroutine_threadsafe(client.send_messages(connection), client.loop)
+    wait_until(lambda: client._queue_waker is not None)
+
+    wakeups = []
+    wakeup_from_thread = client._wakeup_from_thread
+
+    def count_wakeup():
+        wakeups.append(True)
+        wakeup_from_thread()
+
+    monkeypatch.setattr(client, '_wakeup_from_thread', count_wakeup)
+
+    # block the loop, so all patches arrive before the sender can run
+    blocker = threading.Event()
+    client.loop.call_soon_threadsafe(blocker.wait)
+    client.patch('iteration', 1)
+    client.patch('step', 2)
+    client.patch('eta', 3)
+    blocker.set()
+
+    wait_until(lambda: len(connection.sent) == 1)
+    assert len(wakeups) == 1
+    assert connection.sent[0]['action'] == 'patchJob'
+    assert connection.sent[0]['args'][0] == {'iteration': 1, 'step': 2, 'eta': 3}
+
+    stop_sender(client, connection, sender)
+
+
+def test_patches_merged_back_on_connection_closed():
+    client = create_client()
+
+    def fail(message):
+        # a newer value arrives while the patches are sent
+        client.patches['iteration'] = 2
+        raise websockets.exceptions.ConnectionClosedError(None, None)
+
+    client.patches = {'iteration': 1, 'step': 1}
+    run(client, client.send_messages(FakeConnection(on_send=fail)))
+
+    assert client.patches == {'iteration': 2, 'step': 1}
+
+
+def test_get_action_parameters():
+    class Controller:
+        def action(self, a, b):
+            pass
+
+    def function(a):
+        pass
+
+    controller = Controller()
+    assert get_action_parameters(controller.action.__func__) == get_action_parameters(controller.action)
+    assert get_action_parameters(Controller.action) == [
+        {'type': 'any', 'name': '#0'},
+        {'type': 'any', 'name': '#1'},
+        {'type': 'any', 'name': '#2'},
+    ]
+    assert get_action_parameters(function) == [{'type': 'any', 'name': '#0'}]
+
+
+def stop_and_sync(client: Client) -> dict:
+    """
+    Runs stop_and_sync against a fake connection and returns the patches sent.
+    """
+    connection = FakeConnection()
+    client.connection = connection
+    sender = asyncio.run_coroutine_threadsafe(client.send_messages(connection), client.loop)
+    run(client, client.stop_and_sync())
+    client.loop.call_soon_threadsafe(client._wakeup)
+    sender.result(timeout=5)
+
+    assert connection.closed
+    patches = {}
+    for message in connection.sent:
+        assert message['action'] == 'patchJob'
+        patches.update(message['args'][0])
+    return patches
+
+
+def test_stop_and_sync_end_timestamp():
+    client = create_client()
+    patches = stop_and_sync(client)
+
+    assert patches['ended'].endswith('+00:00')
+    assert patches['ended'] == patches['tasks.main.ended'] == patches['tasks.main.instances.0.ended']
+
+
+def test_is_in_directory(tmp_path):
+    directory = tmp_path / 'foo'
+    (directory / 'bar').mkdir(parents=True)
+    (tmp_path / 'foobar').mkdir()
+
+    assert is_in_directory(str(directory), str(directory))
+    assert is_in_directory(str(directory / 'bar'), str(directory))
+    assert is_in_directory(str(directory / 'bar' / 'file.py'), str(directory))
+    assert not is_in_directory(str(tmp_path / 'foobar'), str(directory))
+    assert not is_in_directory(str(tmp_path), str(directory))
+
+
+def test_is_in_directory_symlink(tmp_path):
+    directory = tmp_path / 'foo'
+    directory.mkdir()
+    os.symlink(str(directory), str(tmp_path / 'link'))
+
+    assert is_in_directory(str(tmp_path / 'link' / 'file.py'), str(directory))
+
+
+def test_reap_callbacks(monkeypatch):
+    monkeypatch.setattr(deepkit.client, 'CALLBACK_TIMEOUT', 1)
+    monkeypatch.setattr(deepkit.client, 'REAP_INTERVAL', 0.01)
+    client = create_client()
+
+    async def add_callbacks():
+        lost = client.loop.create_future()
+        pending = client.loop.create_future()
+        client.callbacks[1] = (lost, time.monotonic() - 2)
+        client.callbacks[2] = (pending, time.monotonic())
+        return lost
+
+    lost = run(client, add_callbacks())
+    reaper = asyncio.run_coroutine_threadsafe(client._reap_callbacks(), client.loop)
+    wait_until(lambda: 1 not in client.callbacks)
+    reaper.cancel()
+
+    assert list(client.callbacks.keys()) == [2]
+    with pytest.raises(asyncio.TimeoutError):
+        lost.result()
+
+
+def test_stop_and_sync_bounded_drain(monkeypatch):
+    monkeypatch.setattr(deepkit.client, 'DRAIN_TIMEOUT', 0.1)
+    client = create_client()
+    # no sender is running, so nothing gets drained
+    client.connection = FakeConnection()
+    client.patches['iteration'] = 1
+
+    run(client, client.stop_and_sync())
+
+    assert client.connection.closed
+    assert client.patches['iteration'] == 1
+
+
+def test_unserializable_message_is_dropped():
+    client = create_client()
+    connection = FakeConnection()
+    sender = asyncio.run_coroutine_threadsafe(client.send_messages(connection), client.loop)
+
+    failed = asyncio.run_coroutine_threadsafe(client._message({'name': 'bad', 'value': object()}, lock=False),
+                                              client.loop)
+    run(client, client._message({'name': 'good'}, lock=False, no_response=True))
+
+    wait_until(lambda: len(connection.sent) == 1)
+    assert connection.sent[0]['name'] == 'good'
+    with pytest.raises(TypeError):
+        failed.result(timeout=5)
+    assert not client.queue
+    assert not sender.done()
+
+    stop_sender(client, connection, sender)
+
+
+@pytest.mark.parametrize('last_value, expected', [
+    (None, PATCHES_DONE),
+    (KeyboardInterrupt(), PATCHES_ABORTED),
+    (ValueError('crash'), PATCHES_CRASHED),
+])
+def test_stop_and_sync_status(monkeypatch, last_value, expected):
+    if last_value is None:
+        monkeypatch.delattr(sys, 'last_value', raising=False)
+    else:
+        monkeypatch.setattr(sys, 'last_value', last_value, raising=False)
+
+    client = create_client()
+    client.patches['iteration'] = 5
+    patches = stop_and_sync(client)
+
+    assert patches['iteration'] == 5
+    for key, value in expected.items():
+        assert patches[key] == value
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_shared_loop_after_fork():
+    loop = deepkit.client.get_loop()
+    pid = os.fork()
+    if pid == 0:
+        # child: the parent's loop thread is gone, a new loop has to be started
+        try:
+            child_loop = deepkit.client.get_loop()
+            result = asyncio.run_coroutine_threadsafe(asyncio.sleep(0, 'ok'), child_loop).result(timeout=5)
+            os._exit(0 if child_loop is not loop and result == 'ok' else 1)
+        except BaseException:
+            os._exit(1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_home_config_read_once(monkeypatch):
+    monkeypatch.delenv('DEEPKIT_JOB_ACCESSTOKEN', raising=False)
+    reads = []
+
+    def get_home_config():
+        reads.append(True)
+        account = Account(id='1', port=8960, ssl=False, username='', token='abc', host='localhost', name='local')
+        return HomeConfig(accounts=[account], folderLinks=[])
+
+    async def open_connection(uri):
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr(deepkit.client, 'get_home_config', get_home_config)
+    monkeypatch.setattr(deepkit.client, 'open_connection', open_connection)
+    client = create_client(ContextOptions(account='local'))
+
+    async def connect_twice():
+        for _ in range(2):
+            client.connecting = client.loop.create_future()
+            await client._connect()
+
+    run(client, connect_twice())
+    assert client.offline
+    assert len(reads) == 1
+
+
+def test_unserializable_patch_is_dropped():
+    client = create_client()
+    connection = FakeConnection()
+    sender = asyncio.run_coroutine_threadsafe(client.send_messages(connection), client.loop)
+
+    client.patch('infos.bad', object())
+    client.patch('iteration', 1)
+    wait_until(lambda: len(connection.sent) == 1)
+    assert connection.sent[0]['args'][0] == {'iteration': 1}
+
+    # the sender is still alive
+    run(client, client._message({'name': 'good'}, lock=False, no_response=True))
+    wait_until(lambda: len(connection.sent) == 2)
+    assert connection.sent[1]['name'] == 'good'
+    assert not client.patches
+
+    stop_sender(client, connection, sender)
+
+
+def test_big_integer_patch_falls_back_to_json():
+    client = create_client()
+    connection = FakeConnection()
+    sender = asyncio.run_coroutine_threadsafe(client.send_messages(connection), client.loop)
+
+    client.patch('config.parameters.seed', 2 ** 70)
+    wait_until(lambda: len(connection.sent) == 1)
+    assert connection.sent[0]['args'][0] == {'config.parameters.seed': 2 ** 70}
+
+    stop_sender(client, connection, sender)